@@ -1,5 +1,8 @@
+import codecs
 import logging
 import logging.config
+from collections import OrderedDict
+from datetime import datetime
 
 import praw
 
@@ -43,6 +46,128 @@ def check_user_prunable(username, entry, cutoff_days):
     return False
 
 
+def get_prunable_notes_by_oldest_first(users):
+    """Return all non-ban notes as (username, note) pairs, oldest first"""
+    prunable_notes = [(username, user_note)
+                      for username, entry in users.items()
+                      for user_note in entry['ns'] if not is_ban_related_note(user_note)]
+    prunable_notes.sort(key=lambda x: x[1]['t'])
+    return prunable_notes
+
+
+def estimate_number_of_notes_to_prune(users, size_estimator, prunable_notes, max_wiki_page_size):
+    """Estimate how many of the given notes must be pruned to fit the budget, without recompressing the users blob"""
+    remaining_notes_per_user = dict((username, len(entry['ns'])) for username, entry in users.items())
+    for number_of_pruned_notes, (username, user_note) in enumerate(prunable_notes):
+        if size_estimator.estimated_page_size() <= max_wiki_page_size:
+            return number_of_pruned_notes
+        size_estimator.remove_note(user_note)
+        remaining_notes_per_user[username] -= 1
+        if remaining_notes_per_user[username] == 0:
+            size_estimator.remove_user(username, dict(users[username], ns=[]))
+    return len(prunable_notes)
+
+
+def get_users_without_notes(users, notes_to_prune):
+    """Return a copy of the given users in their original order without the given notes.
+
+    Users left without any notes are dropped. The original order is kept because it affects the compressed size.
+    """
+    ids_of_notes_to_prune = set(id(user_note) for _, user_note in notes_to_prune)
+    remaining_users = OrderedDict()
+    for username, entry in users.items():
+        remaining_notes = [user_note for user_note in entry['ns'] if id(user_note) not in ids_of_notes_to_prune]
+        if len(remaining_notes) > 0 or len(entry['ns']) == 0:
+            remaining_users[username] = dict(entry, ns=remaining_notes)
+    return remaining_users
+
+
+def get_page_size(usernotes_wrapper, users):
+    """Return the actual wiki page size of the usernotes with the given users"""
+    pruned_usernotes = usernotes.UsernotesWrapper(usernotes_wrapper.compressed_json_data, users)
+    return len(usernotes.dump_wiki_page_content(pruned_usernotes))
+
+
+def prune_to_size_budget(usernotes_wrapper, max_wiki_page_size):
+    """Prune the fewest oldest non-ban notes needed for the wiki page to fit the budget, return the pruned notes.
+
+    The compressed size estimate picks the first cut. The exact cut is then searched with actual wiki page sizes,
+    first in growing steps away from the estimate and then by bisecting, so only a few recompressions are needed
+    and estimation errors never cause more notes to be pruned than necessary.
+    """
+    users = usernotes_wrapper.decoded_users_blob_json
+    size_estimator = usernotes.WikiPageSizeEstimator(usernotes_wrapper)
+    logging.info('wiki page size before size budget pruning: {0} bytes'.format(size_estimator.actual_page_size))
+    if size_estimator.actual_page_size <= max_wiki_page_size:
+        return []
+
+    prunable_notes = get_prunable_notes_by_oldest_first(users)
+    estimated_cut = estimate_number_of_notes_to_prune(users, size_estimator, prunable_notes, max_wiki_page_size)
+    fitting_users_by_cut = {}
+
+    def fits_budget(cut):
+        remaining_users = get_users_without_notes(users, prunable_notes[:cut])
+        if get_page_size(usernotes_wrapper, remaining_users) > max_wiki_page_size:
+            return False
+        fitting_users_by_cut.clear()
+        fitting_users_by_cut[cut] = remaining_users
+        return True
+
+    # pruning too_few_notes never fits the budget, pruning enough_notes does
+    step = 1
+    if fits_budget(estimated_cut):
+        enough_notes = estimated_cut
+        too_few_notes = None
+        while too_few_notes is None:
+            cut = max(enough_notes - step, 0)
+            if cut == 0 or not fits_budget(cut):
+                too_few_notes = cut
+            else:
+                enough_notes = cut
+                step *= 2
+    else:
+        too_few_notes = estimated_cut
+        enough_notes = None
+        while enough_notes is None:
+            if too_few_notes == len(prunable_notes):
+                logging.warning('not enough prunable notes, wiki page stays above the size budget of {0} bytes'
+                                .format(max_wiki_page_size))
+                usernotes_wrapper.decoded_users_blob_json = get_users_without_notes(users, prunable_notes)
+                return prunable_notes
+            cut = min(too_few_notes + step, len(prunable_notes))
+            if fits_budget(cut):
+                enough_notes = cut
+            else:
+                too_few_notes = cut
+                step *= 2
+
+    while enough_notes - too_few_notes > 1:
+        cut = (too_few_notes + enough_notes) // 2
+        if fits_budget(cut):
+            enough_notes = cut
+        else:
+            too_few_notes = cut
+
+    usernotes_wrapper.decoded_users_blob_json = fitting_users_by_cut[enough_notes]
+    page_size = get_page_size(usernotes_wrapper, usernotes_wrapper.decoded_users_blob_json)
+    logging.info('wiki page size after pruning {0} notes: {1} bytes'.format(enough_notes, page_size))
+    if page_size > max_wiki_page_size:
+        logging.warning('wiki page size of {0} bytes is above the size budget of {1} bytes'
+                        .format(page_size, max_wiki_page_size))
+    return prunable_notes[:enough_notes]
+
+
+def write_size_budget_report(report_file_name, pruned_notes, max_wiki_page_size):
+    """Write a report listing the notes that are pruned to fit the wiki page into the size budget"""
+    with codecs.open(report_file_name, 'w', 'utf-8') as report_file:
+        report_file.write(u'{0} notes pruned to fit the usernotes wiki page into {1} bytes\n'.format(
+            len(pruned_notes), max_wiki_page_size))
+        for username, user_note in pruned_notes:
+            date_of_user_note = datetime.utcfromtimestamp(user_note['t']).strftime('%Y-%m-%d')
+            report_file.write(u'{0}\t/u/{1}\t{2}\n'.format(date_of_user_note, username, user_note['n']))
+    logging.info('wrote size budget pruning report to {0}'.format(report_file_name))
+
+
 # global reddit session
 r = None
 
@@ -62,6 +187,9 @@ def main():
     try:
         cutoff_days_for_users_with_only_one_note = 25
         cutoff_days_for_all_notes = 50
+        max_wiki_page_size = None
+        size_budget_report_file_name = 'usernotes_pruning_report.txt'
+        dry_run = False
 
         logging.info("Checking users with notes older than {0} days or a single note older than {1} days"
                      .format(cutoff_days_for_all_notes, cutoff_days_for_users_with_only_one_note))
@@ -78,7 +206,18 @@ def main():
         wiki_page_edit_reason = 'User notes pruning: ' + \
             'notes older than {0} days '.format(cutoff_days_for_all_notes) + \
             'and single note users where note is older than {0} days'.format(cutoff_days_for_users_with_only_one_note)
-        usernotes.save_to_wiki_page(r, usernotes_wrapper, wiki_page_edit_reason, subreddit_name)
+
+        if max_wiki_page_size is not None:
+            pruned_notes = prune_to_size_budget(usernotes_wrapper, max_wiki_page_size)
+            write_size_budget_report(size_budget_report_file_name, pruned_notes, max_wiki_page_size)
+            logging.info('users after size budget pruning: {0}'.format(len(usernotes_wrapper.decoded_users_blob_json)))
+            if len(pruned_notes) > 0:
+                wiki_page_edit_reason += ' and oldest notes to fit into {0} bytes'.format(max_wiki_page_size)
+
+        if dry_run:
+            logging.info('dry run, not saving pruned usernotes to subreddit {0}'.format(subreddit_name))
+        else:
+            usernotes.save_to_wiki_page(r, usernotes_wrapper, wiki_page_edit_reason, subreddit_name)
 
     except Exception as exception:
         logging.exception(exception)
@@ -1,6 +1,8 @@
 import base64
 import json
 import logging
+import math
+import os
 import zlib
 from datetime import datetime
 
@@ -49,6 +51,99 @@ def recompress_users_blob(modified_users_json):
     return base64.b64encode(recompressed)
 
 
+def get_serialized_size_of_user_note(user_note):
+    """Return the number of bytes the given usernote occupies in the uncompressed users blob, including its separator"""
+    return len(json.dumps(user_note, separators=(',', ':'))) + 1
+
+
+def get_serialized_size_of_user(username, entry):
+    """Return the number of bytes the given user entry occupies in the uncompressed users blob, including separators"""
+    return len(json.dumps(username)) + len(json.dumps(entry, separators=(',', ':'))) + 2
+
+
+def get_digest(json_value):
+    """Return a compact checksum of the canonical json representation of the given value"""
+    json_dump = json.dumps(json_value, sort_keys=True, separators=(',', ':'))
+    return zlib.crc32(json_dump.encode('UTF-8')) & 0xffffffff
+
+
+def get_note_key(user_note):
+    """Return the key identifying the given usernote in a fingerprint, its time and mod plus its content digest"""
+    return user_note['t'], user_note['m'], get_digest(user_note)
+
+
+def fingerprint_user(entry_digest, note_keys):
+    """Return the fingerprint of a single user from the digest of its entry and the keys of its usernotes"""
+    return {'d': entry_digest, 'ns': note_keys}
+
+
+def fingerprint_users(users):
+    """Return a compact fingerprint of the given users, a digest per user and a key per usernote"""
+    fingerprints = {}
+    for username, entry in users.items():
+        note_keys = [get_note_key(user_note) for user_note in entry['ns']]
+        fingerprints[username] = fingerprint_user(get_digest(entry), note_keys)
+    return fingerprints
+
+
+def get_note_deltas(previous_note_keys, user_notes, note_keys):
+    """Match the given usernotes and their keys against the previous note keys by content.
+
+    Returns the added, changed and removed notes. An added note that shares time and mod with a removed note key is
+    reported as changed instead.
+    """
+    unmatched_previous_note_keys = list(previous_note_keys)
+    unmatched_notes = []
+    for user_note, note_key in zip(user_notes, note_keys):
+        if note_key in unmatched_previous_note_keys:
+            unmatched_previous_note_keys.remove(note_key)
+        else:
+            unmatched_notes.append(user_note)
+
+    added_notes = []
+    changed_notes = []
+    for user_note in unmatched_notes:
+        replaced_note_keys = [note_key for note_key in unmatched_previous_note_keys
+                              if note_key[:2] == (user_note['t'], user_note['m'])]
+        if len(replaced_note_keys) > 0:
+            unmatched_previous_note_keys.remove(replaced_note_keys[0])
+            changed_notes.append(user_note)
+        else:
+            added_notes.append(user_note)
+
+    return added_notes, changed_notes, unmatched_previous_note_keys
+
+
+def get_changes_and_fingerprints(previous_fingerprints, users):
+    """Return the changes since the previous fingerprints together with the fingerprints of the given users.
+
+    There is a UsernotesChange for every user whose notes were added, removed or changed. Unchanged users are
+    recognized by the digest of their entry and keep their previous fingerprint without digesting their notes.
+    """
+    changes = []
+    fingerprints = {}
+    for username, entry in users.items():
+        entry_digest = get_digest(entry)
+        previous_fingerprint = previous_fingerprints.get(username)
+        if previous_fingerprint is not None and previous_fingerprint['d'] == entry_digest:
+            fingerprints[username] = previous_fingerprint
+            continue
+
+        user_notes = entry['ns']
+        note_keys = [get_note_key(user_note) for user_note in user_notes]
+        fingerprints[username] = fingerprint_user(entry_digest, note_keys)
+        previous_note_keys = previous_fingerprint['ns'] if previous_fingerprint is not None else []
+        added_notes, changed_notes, removed_note_keys = get_note_deltas(previous_note_keys, user_notes, note_keys)
+        if added_notes or changed_notes or removed_note_keys:
+            changes.append(UsernotesChange(username, added_notes, changed_notes, removed_note_keys))
+
+    for username, previous_fingerprint in previous_fingerprints.items():
+        if username not in users:
+            changes.append(UsernotesChange(username, [], [], list(previous_fingerprint['ns'])))
+
+    return changes, fingerprints
+
+
 def load_from_wiki_page(r, subreddit_name):
     """Load the usernotes json data from the usernotes wiki page of the given subreddit"""
     logging.info('loading usernotes from subreddit {0}'.format(subreddit_name))
@@ -65,15 +160,24 @@ def load_from_wiki_page(r, subreddit_name):
     return UsernotesWrapper(json_data, decompressed_users_blob_json)
 
 
+def build_wiki_page_json_data(usernotes):
+    """Return a copy of the usernotes json data with the users blob recompressed from the decoded users"""
+    json_data = dict(usernotes.compressed_json_data)
+    json_data[USERS_BLOB_PROPERTY_NAME] = recompress_users_blob(usernotes.decoded_users_blob_json)
+    return json_data
+
+
+def dump_wiki_page_content(usernotes):
+    """Recompress the users blob into a copy of the usernotes json data and return the resulting wiki page content"""
+    json_data = build_wiki_page_json_data(usernotes)
+    return json.dumps(json_data, separators=(',', ':'))
+
+
 def save_to_wiki_page(r, usernotes, edit_reason, subreddit_name):
     """Save the usernotes json data to the usernotes wiki page of the given subreddit"""
-    logging.info('recompressing users blob for storing usernotes json ...')
-    json_data = usernotes.compressed_json_data
-    json_data[USERS_BLOB_PROPERTY_NAME] = recompress_users_blob(usernotes.decoded_users_blob_json)
-    logging.info('done recompressing users blob for storing usernotes json')
-    logging.info('dumping usernotes json to string representation ...')
-    json_dump = json.dumps(json_data, separators=(',', ':'))
-    logging.info('done dumping usernotes json to string representation')
+    logging.info('recompressing users blob and dumping usernotes json to string representation ...')
+    json_dump = dump_wiki_page_content(usernotes)
+    logging.info('done recompressing users blob and dumping usernotes json to string representation')
     logging.info('writing usernotes to subreddit {0}'.format(subreddit_name))
     r.subreddit(subreddit_name).wiki[USERNOTES_WIKI_PAGE_NAME].edit(json_dump, edit_reason)
     logging.info('done writing usernotes to subreddit {0}'.format(subreddit_name))
@@ -85,3 +189,107 @@ class UsernotesWrapper:
     def __init__(self, compressed_json_data, decoded_users_blob_json):
         self.compressed_json_data = compressed_json_data
         self.decoded_users_blob_json = decoded_users_blob_json
+
+
+class WikiPageSizeEstimator:
+    """Estimates the size of the usernotes wiki page while notes are removed, without recompressing the users blob.
+
+    The page is compressed once on creation to measure the compression ratio of the users blob and the size of
+    everything around it; removals then only adjust the uncompressed size, which is scaled by that ratio.
+    """
+
+    def __init__(self, usernotes):
+        json_data = build_wiki_page_json_data(usernotes)
+        encoded_blob_size = len(json_data[USERS_BLOB_PROPERTY_NAME])
+        self.actual_page_size = len(json.dumps(json_data, separators=(',', ':')))
+        self.surrounding_size = self.actual_page_size - encoded_blob_size
+        self.uncompressed_blob_size = len(json.dumps(usernotes.decoded_users_blob_json, separators=(',', ':')))
+        compressed_blob_size = encoded_blob_size // 4 * 3
+        self.compression_ratio = float(compressed_blob_size) / max(self.uncompressed_blob_size, 1)
+
+    def remove_note(self, user_note):
+        """Account for the given usernote being removed from the users blob"""
+        self.uncompressed_blob_size -= get_serialized_size_of_user_note(user_note)
+
+    def remove_user(self, username, entry):
+        """Account for the given user entry being removed from the users blob"""
+        self.uncompressed_blob_size -= get_serialized_size_of_user(username, entry)
+
+    def estimated_page_size(self):
+        """Return the estimated size in bytes of the wiki page after all removals so far"""
+        estimated_compressed_blob_size = self.compression_ratio * self.uncompressed_blob_size
+        return self.surrounding_size + 4 * int(math.ceil(estimated_compressed_blob_size / 3))
+
+
+class UsernotesChange:
+    """The usernotes of a single user that were added, changed or removed between two snapshots.
+
+    Added and changed notes are the usernotes of the new snapshot. Removed notes are only known by their note key,
+    a (time, mod index, digest) tuple, as the stored fingerprint does not keep enough to rebuild their text or link.
+    Mod and warning indexes refer to the constants of the usernotes passed to subscribers along with the change.
+    """
+
+    def __init__(self, username, added_notes, changed_notes, removed_note_keys):
+        self.username = username
+        self.added_notes = added_notes
+        self.changed_notes = changed_notes
+        self.removed_note_keys = removed_note_keys
+
+
+class UsernotesChangeFeed:
+    """Publishes the usernotes changes since the last processed snapshot to subscribers.
+
+    The fingerprints of the last processed snapshot are kept in the given state file between runs. Without a state
+    file, the first snapshot is only stored and publishes no changes, unless publish_initial_snapshot is set, in which
+    case every existing note is published as added.
+    """
+
+    def __init__(self, state_file_name, publish_initial_snapshot=False):
+        self.state_file_name = state_file_name
+        self.publish_initial_snapshot = publish_initial_snapshot
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        """Register a callback to be called with every UsernotesChange and the UsernotesWrapper it belongs to"""
+        self.subscribers.append(callback)
+
+    def load_fingerprints(self):
+        """Return the fingerprints of the last processed snapshot, or None if there is none or it is unreadable"""
+        try:
+            with open(self.state_file_name) as state_file:
+                fingerprints = json.load(state_file)
+            for fingerprint in fingerprints.values():
+                fingerprint['ns'] = [tuple(note_key) for note_key in fingerprint['ns']]
+        except IOError:
+            logging.info('no usernotes snapshot found in {0}'.format(self.state_file_name))
+            return None
+        except (ValueError, KeyError, TypeError, AttributeError) as exception:
+            logging.warning('ignoring unreadable usernotes snapshot in {0}: {1}'.format(self.state_file_name,
+                                                                                       exception))
+            return None
+        return fingerprints
+
+    def save_fingerprints(self, fingerprints):
+        """Store the given fingerprints as the last processed snapshot, replacing the state file only once written"""
+        temporary_state_file_name = self.state_file_name + '.tmp'
+        with open(temporary_state_file_name, 'w') as state_file:
+            json.dump(fingerprints, state_file, separators=(',', ':'))
+        os.rename(temporary_state_file_name, self.state_file_name)
+
+    def publish(self, usernotes):
+        """Pass every change since the last processed snapshot to all subscribers, then store the new snapshot"""
+        users = usernotes.decoded_users_blob_json
+        previous_fingerprints = self.load_fingerprints()
+        if previous_fingerprints is None:
+            if not self.publish_initial_snapshot:
+                self.save_fingerprints(fingerprint_users(users))
+                return
+            previous_fingerprints = {}
+
+        logging.info('determining usernotes changes since last snapshot ...')
+        changes, fingerprints = get_changes_and_fingerprints(previous_fingerprints, users)
+        logging.info('found usernotes changes for {0} users'.format(len(changes)))
+        for change in changes:
+            for subscriber in self.subscribers:
+                subscriber(change, usernotes)
+        self.save_fingerprints(fingerprints)